@@ -4,8 +4,9 @@ import numpy as np
 from datetime import datetime, timedelta
 from typing import Optional
 from data_loader import load_spot_csv, load_fo_csv
-import duckdb, os, glob
+import os, glob
 from lot_size import resolve_lot_size
+from data_service import DataService, DuckDBBackend, FrameBackend
 
 st.set_page_config(page_title="Options Simulator", layout="wide")
 
@@ -19,6 +20,17 @@ except Exception:
     default_drive_folder = ""
 
 
+# One DataService per FO source, shared by every session of this server process.
+# Evicted services shut down their loop/pool/connection via weakref.finalize.
+@st.cache_resource(show_spinner=False, max_entries=4, ttl=6*3600)
+def get_store_service(duckdb_file, parquet_dir):
+    return DataService(DuckDBBackend(duckdb_file, parquet_dir), max_workers=min(4, os.cpu_count() or 1))
+
+@st.cache_resource(show_spinner=False, max_entries=2, ttl=6*3600)
+def get_frame_service(_fo_df, key):
+    return DataService(FrameBackend(_fo_df), max_workers=min(4, os.cpu_count() or 1))
+
+
 # --- Sidebar: data sources ---
 st.sidebar.header("Data Sources")
 
@@ -53,6 +65,8 @@ with st.sidebar.expander("Google Drive ingest", expanded=False):
         st.info("Starting ingestion... this may take a long time for 15GB + network latency.")
         code = subprocess.call(cmd, cwd=str(root_dir))
         if code == 0:
+            # Drop services built on the old store so the next run reopens it.
+            get_store_service.clear()
             st.success("Ingestion completed. Fill paths above and reload the app.")
         else:
             st.error(f"Ingestion failed with code {code}. Check logs.")
@@ -79,7 +93,9 @@ def load_all(_spot_bytes, _fo_bytes, _spot_path, _fo_path):
         fo_df = load_fo_csv(_fo_path)
     return spot_df, fo_df
 
-if mode == 'Parquet/DuckDB' and (duckdb_file or parquet_dir):
+use_store = mode == 'Parquet/DuckDB' and bool(duckdb_file or parquet_dir)
+
+if use_store:
     spot_df = load_spot_csv(spot_file or default_spot_path)
     # Delay-load FO; we won't materialize entire 15GB—later we query with filters.
     fo_df = None
@@ -90,10 +106,15 @@ colA, colB, colC = st.columns([1,2,2])
 with colA:
     st.markdown("### Options Simulator")
 
-if spot_df is None or fo_df is None:
+if spot_df is None or (fo_df is None and not use_store):
     st.info("Upload or point to the two CSVs in the sidebar to begin.")
     st.stop()
 
+if use_store:
+    svc = get_store_service(duckdb_file, parquet_dir)
+else:
+    svc = get_frame_service(fo_df, fo_file.file_id if fo_file is not None else default_fo_path)
+
 symbols = sorted(list(spot_df['Ticker'].dropna().unique()))
 symbol = st.selectbox("Select Index/Stock", options=symbols, index=0)
 
@@ -107,13 +128,11 @@ with d2:
     end_date = st.date_input("Payoff Date", value=max_dt, min_value=min_dt, max_value=max_dt)
 
 # Expiry selection from FO
-if mode == 'Parquet/DuckDB' and (duckdb_file or parquet_dir):
-    con = duckdb.connect(database=duckdb_file if duckdb_file else ':memory:')
-    if not duckdb_file:
-        con.sql(f"CREATE OR REPLACE VIEW fo AS SELECT * FROM read_parquet('{parquet_dir}/**/*.parquet')")
-    expiries = con.sql(f"SELECT DISTINCT DATE(EXPIRY_DT) AS e FROM fo WHERE SYMBOL = '{symbol}' ORDER BY e").df()['e'].dt.date.tolist()
-else:
-    expiries = fo_df.loc[fo_df['SYMBOL'].eq(symbol), 'EXPIRY_DT'].dropna().dt.date.unique()
+try:
+    expiries = svc.expiries(symbol)
+except Exception as e:
+    st.error(f"Expiry lookup failed: {e}")
+    st.stop()
 expiries = sorted(list(set(expiries)))
 expiry = st.selectbox("Select Expiry", options=expiries, index=0 if expiries else None)
 
@@ -139,25 +158,14 @@ if pd.isna(now_ts):
 
 # resolve futures price near ts from FO (FUTIDX/FUTSTK rows)
 def futures_price_at(ts: pd.Timestamp) -> float:
-    if mode == 'Parquet/DuckDB' and (duckdb_file or parquet_dir):
-        con = duckdb.connect(database=duckdb_file if duckdb_file else ':memory:')
-        if not duckdb_file:
-            con.sql(f"CREATE OR REPLACE VIEW fo AS SELECT * FROM read_parquet('{parquet_dir}/**/*.parquet')")
-        q = f"""
-            SELECT CLOSE FROM fo
-            WHERE SYMBOL = '{symbol}' AND INSTRUMENT ILIKE 'FUT%'
-              AND Timestamp <= TIMESTAMP '{ts}'
-            ORDER BY Timestamp DESC
-            LIMIT 1
-        """
-        r = con.sql(q).df()
-        return float(r['CLOSE'].iloc[0]) if len(r) else float('nan')
-    else:
-        r = fo_df[(fo_df['SYMBOL'].eq(symbol)) & (fo_df['INSTRUMENT'].str.contains('FUT', na=False)) & (fo_df['Timestamp']<=ts)]
-        return float(r['CLOSE'].iloc[-1]) if len(r) else np.nan
+    try:
+        return svc.futures_price_at(symbol, ts)
+    except Exception as e:
+        st.warning(f"Futures price lookup failed: {e}")
+        return np.nan
 
 lot_override = st.sidebar.number_input("Lot size override", min_value=1, value=0, help="Leave 0 to auto-resolve")
-if mode == 'Parquet/DuckDB' and (duckdb_file or parquet_dir):
+if use_store:
     lot = resolve_lot_size(symbol, now_ts.to_pydatetime(), fo_slice=None, override=lot_override if lot_override>0 else None)
 else:
     lot = resolve_lot_size(symbol, now_ts.to_pydatetime(), fo_slice=fo_df[fo_df['SYMBOL'].eq(symbol)], override=lot_override if lot_override>0 else None)
@@ -245,3 +253,7 @@ if len(trades):
     st.metric("Unrealized P&L", f"{trades['UPnL'].sum():,.0f}")
 else:
     st.info("No trades yet.")
+
+with st.sidebar.expander("Data service stats", expanded=False):
+    st.caption("Shared across all sessions. `coalesced` calls piggy-backed on an identical in-flight query.")
+    st.dataframe(svc.latency_stats(), hide_index=True)
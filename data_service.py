@@ -0,0 +1,345 @@
+from __future__ import annotations
+import asyncio, concurrent.futures, threading, time, weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+# Shared, in-process query service for multi-user deployments.
+# All Streamlit sessions talk to one DataService, which:
+#   - coalesces identical in-flight queries into a single backend call,
+#   - caches completed results, so repeat lookups across sessions skip the store,
+#   - batches concurrent futures-price point lookups per symbol into one scan,
+#   - runs backend work on a bounded thread pool,
+#   - keeps per-query latency stats.
+# The asyncio loop lives on its own daemon thread; the sync wrappers below
+# are what app.py calls from the (threaded) Streamlit script runner.
+
+
+class DuckDBBackend:
+    """FO store backed by a DuckDB file or a partitioned Parquet directory."""
+
+    def __init__(self, duckdb_file: str = "", parquet_dir: str = ""):
+        self._duckdb_file = duckdb_file
+        self._con = None
+        if not duckdb_file:
+            import duckdb
+            self._con = duckdb.connect(database=':memory:')
+            self._con.sql(f"CREATE OR REPLACE VIEW fo AS SELECT * FROM read_parquet('{parquet_dir}/**/*.parquet')")
+        self._local = threading.local()
+
+    def _execute(self, sql: str, params: List) -> pd.DataFrame:
+        if self._duckdb_file:
+            # Short-lived read-only connection per query: holding the file open
+            # would lock out ingest/preprocess runs that rebuild the store.
+            import duckdb
+            con = duckdb.connect(database=self._duckdb_file, read_only=True)
+            try:
+                return con.execute(sql, params).df()
+            finally:
+                con.close()
+        # DuckDB connections are not safe to share across threads; give each
+        # pool worker its own cursor on the same in-memory database.
+        cur = getattr(self._local, "cur", None)
+        if cur is None:
+            cur = self._con.cursor()
+            self._local.cur = cur
+        return cur.execute(sql, params).df()
+
+    def expiries(self, symbol: str) -> List:
+        df = self._execute("SELECT DISTINCT DATE(EXPIRY_DT) AS e FROM fo WHERE SYMBOL = ? ORDER BY e", [symbol])
+        return df['e'].dt.date.tolist()
+
+    def futures_prices(self, symbol: str, ts_list: List[pd.Timestamp]) -> List[float]:
+        # One ASOF scan answers every probe timestamp in the batch.
+        r = self._execute("""
+            SELECT p.i, f.CLOSE
+            FROM (SELECT UNNEST(?) AS ts, UNNEST(range(?)) AS i) p
+            ASOF LEFT JOIN (
+                SELECT Timestamp, CLOSE FROM fo
+                WHERE SYMBOL = ? AND INSTRUMENT ILIKE 'FUT%'
+            ) f ON p.ts >= f.Timestamp
+            ORDER BY p.i
+        """, [[pd.Timestamp(t).to_pydatetime() for t in ts_list], len(ts_list), symbol])
+        return [float(x) if pd.notna(x) else float('nan') for x in r['CLOSE']]
+
+    def close(self) -> None:
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+class FrameBackend:
+    """FO store backed by an in-memory DataFrame (CSV mode)."""
+
+    def __init__(self, fo_df: pd.DataFrame):
+        self._fo = fo_df
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def expiries(self, symbol: str) -> List:
+        return list(self._fo.loc[self._fo['SYMBOL'].eq(symbol), 'EXPIRY_DT'].dropna().dt.date.unique())
+
+    def _futures_series(self, symbol: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Filter + sort the futures rows of a symbol once; batches only searchsorted.
+        # The CSV need not be time-sorted, and the answer for ts is the *last row
+        # in file order* with Timestamp <= ts, so keep a running max of file
+        # position over the time-sorted rows.
+        with self._lock:
+            series = self._futures.get(symbol)
+            if series is None:
+                fo = self._fo
+                fut = fo[fo['SYMBOL'].eq(symbol) & fo['INSTRUMENT'].str.contains('FUT', na=False) & fo['Timestamp'].notna()]
+                closes = fut['CLOSE'].to_numpy(dtype=float)
+                order = np.argsort(fut['Timestamp'].to_numpy(), kind='stable')
+                stamps = fut['Timestamp'].to_numpy()[order]
+                last_pos = np.maximum.accumulate(order) if len(order) else order
+                series = self._futures[symbol] = (stamps, last_pos, closes)
+            return series
+
+    def futures_prices(self, symbol: str, ts_list: List[pd.Timestamp]) -> List[float]:
+        stamps, last_pos, closes = self._futures_series(symbol)
+        probes = pd.to_datetime(ts_list)
+        idx = np.searchsorted(stamps, probes.to_numpy(), side='right') - 1
+        # searchsorted places NaT after every timestamp; the old filter matched nothing.
+        return [float(closes[last_pos[i]]) if i >= 0 and not pd.isna(t) else np.nan
+                for i, t in zip(idx, probes)]
+
+    def close(self) -> None:
+        with self._lock:
+            self._futures.clear()
+
+
+class QueryStats:
+    """Thread-safe per-query-kind counters and latency samples."""
+
+    def __init__(self, window: int = 1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self._calls: Dict[str, int] = {}
+        self._coalesced: Dict[str, int] = {}
+        self._cache_hits: Dict[str, int] = {}
+        self._backend: Dict[str, int] = {}
+        self._latency: Dict[str, Deque[float]] = {}
+        self._backend_latency: Dict[str, Deque[float]] = {}
+
+    def _samples(self, store: Dict[str, Deque[float]], kind: str) -> Deque[float]:
+        if kind not in store:
+            store[kind] = deque(maxlen=self._window)
+        return store[kind]
+
+    def record_call(self, kind: str, seconds: float, coalesced: bool = False, cached: bool = False) -> None:
+        with self._lock:
+            self._calls[kind] = self._calls.get(kind, 0) + 1
+            if coalesced:
+                self._coalesced[kind] = self._coalesced.get(kind, 0) + 1
+            if cached:
+                self._cache_hits[kind] = self._cache_hits.get(kind, 0) + 1
+            self._samples(self._latency, kind).append(seconds)
+
+    def record_backend(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            self._backend[kind] = self._backend.get(kind, 0) + 1
+            self._samples(self._backend_latency, kind).append(seconds)
+
+    def snapshot(self) -> pd.DataFrame:
+        rows = []
+        with self._lock:
+            for kind in sorted(self._calls):
+                lat = np.array(self._latency.get(kind, ()), dtype=float) * 1000.0
+                blat = np.array(self._backend_latency.get(kind, ()), dtype=float) * 1000.0
+                rows.append({
+                    "query": kind,
+                    "calls": self._calls[kind],
+                    "cache_hits": self._cache_hits.get(kind, 0),
+                    "coalesced": self._coalesced.get(kind, 0),
+                    "backend_queries": self._backend.get(kind, 0),
+                    "p50_ms": float(np.percentile(lat, 50)) if len(lat) else np.nan,
+                    "p95_ms": float(np.percentile(lat, 95)) if len(lat) else np.nan,
+                    "max_ms": float(lat.max()) if len(lat) else np.nan,
+                    "backend_p50_ms": float(np.percentile(blat, 50)) if len(blat) else np.nan,
+                })
+        return pd.DataFrame(rows)
+
+
+class ResultCache:
+    """Bounded LRU of completed query results with an optional TTL (loop-thread only)."""
+
+    _MISS = object()
+
+    def __init__(self, max_entries: int = 4096, ttl: Optional[float] = None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._data: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Tuple) -> Any:
+        hit = self._data.get(key)
+        if hit is None:
+            return self._MISS
+        stored_at, value = hit
+        if self._ttl is not None and time.monotonic() - stored_at > self._ttl:
+            del self._data[key]
+            return self._MISS
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Tuple, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_entries:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+def _shutdown(loop: asyncio.AbstractEventLoop, thread: threading.Thread,
+              pool: ThreadPoolExecutor, backend) -> None:
+    # Kept free of any DataService reference so weakref.finalize can run it
+    # once the service is evicted from the Streamlit resource cache. GC may
+    # also fire it on the loop or a pool thread, which must not join itself.
+    current = threading.current_thread()
+    internal = current is thread or current.name.startswith("data-service")
+    loop.call_soon_threadsafe(loop.stop)
+    if not internal:
+        thread.join()
+        loop.close()
+    pool.shutdown(wait=not internal)
+    close = getattr(backend, "close", None)
+    if close is not None:
+        close()
+
+
+class DataService:
+    def __init__(self, backend, max_workers: int = 4, max_batch: int = 256, timeout: Optional[float] = 30.0,
+                 cache_entries: int = 4096, cache_ttl: Optional[float] = 3600.0):
+        self._backend = backend
+        self._max_batch = max_batch
+        self._timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="data-service")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="data-service-loop", daemon=True)
+        self._thread.start()
+        # Loop-thread-only state.
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self._batches: Dict[str, Dict[pd.Timestamp, asyncio.Future]] = {}
+        self._running: Dict[str, int] = {}
+        # The store only changes on rebuild, and app.py drops the whole service then.
+        self._results = ResultCache(cache_entries, cache_ttl)
+        self.stats = QueryStats()
+        self._finalizer = weakref.finalize(self, _shutdown, self._loop, self._thread, self._pool, backend)
+
+    # --- async API (run on the service loop) ---
+
+    async def _run(self, kind: str, fn: Callable[..., Any], *args) -> Any:
+        t0 = time.perf_counter()
+        try:
+            return await self._loop.run_in_executor(self._pool, fn, *args)
+        finally:
+            self.stats.record_backend(kind, time.perf_counter() - t0)
+
+    async def _coalesce(self, key: Tuple, factory: Callable[[], Awaitable[Any]]) -> Any:
+        kind = key[0]
+        t0 = time.perf_counter()
+        cached = self._results.get(key)
+        if cached is not ResultCache._MISS:
+            self.stats.record_call(kind, time.perf_counter() - t0, cached=True)
+            return cached
+        fut = self._inflight.get(key)
+        coalesced = fut is not None
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self._inflight[key] = fut
+
+            def _done(f, key=key):
+                if self._inflight.get(key) is f:
+                    del self._inflight[key]
+                if not f.cancelled() and f.exception() is None:
+                    self._results.put(key, f.result())
+            fut.add_done_callback(_done)
+        try:
+            # shield: one caller giving up must not cancel the shared query
+            return await asyncio.shield(fut)
+        finally:
+            self.stats.record_call(kind, time.perf_counter() - t0, coalesced=coalesced)
+
+    async def expiries_async(self, symbol: str) -> List:
+        return await self._coalesce(("expiries", symbol),
+                                    lambda: self._run("expiries", self._backend.expiries, symbol))
+
+    async def futures_price_async(self, symbol: str, ts: pd.Timestamp) -> float:
+        ts = pd.Timestamp(ts)
+        if pd.isna(ts):
+            return float('nan')
+        return await self._coalesce(("futures_price", symbol, ts),
+                                    lambda: self._enqueue_point(symbol, ts))
+
+    def _enqueue_point(self, symbol: str, ts: pd.Timestamp) -> asyncio.Future:
+        # No timer: a lone lookup is sent straight away (on the next loop tick,
+        # so lookups submitted together still share it). Lookups arriving while
+        # a scan for the symbol is running queue up and go out as one batch
+        # when it finishes, or as soon as max_batch is reached.
+        batch = self._batches.get(symbol)
+        if batch is None:
+            batch = self._batches[symbol] = {}
+            if not self._running.get(symbol):
+                self._loop.call_soon(self._flush, symbol, batch)
+        fut = batch.get(ts)
+        if fut is None:
+            fut = batch[ts] = self._loop.create_future()
+        if len(batch) >= self._max_batch:
+            self._flush(symbol, batch)
+        return fut
+
+    def _flush(self, symbol: str, batch: Dict[pd.Timestamp, asyncio.Future]) -> None:
+        # A scheduled flush may find its batch already taken by a size-triggered one.
+        if self._batches.get(symbol) is not batch:
+            return
+        del self._batches[symbol]
+        self._running[symbol] = self._running.get(symbol, 0) + 1
+        self._loop.create_task(self._run_batch(symbol, batch))
+
+    async def _run_batch(self, symbol: str, batch: Dict[pd.Timestamp, asyncio.Future]) -> None:
+        stamps = list(batch)
+        try:
+            prices = await self._run("futures_price", self._backend.futures_prices, symbol, stamps)
+        except Exception as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+        else:
+            for ts, px in zip(stamps, prices):
+                if not batch[ts].done():
+                    batch[ts].set_result(px)
+        finally:
+            self._running[symbol] -= 1
+            if not self._running[symbol]:
+                del self._running[symbol]
+                pending = self._batches.get(symbol)
+                if pending:
+                    self._flush(symbol, pending)
+
+    # --- sync API (safe to call from any thread) ---
+
+    def _call(self, coro: Awaitable[Any], what: str, timeout: Optional[float] = None) -> Any:
+        timeout = self._timeout if timeout is None else timeout
+        fut = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Only this caller's wait is cancelled; the shared query is shielded.
+            fut.cancel()
+            raise TimeoutError(f"{what} query timed out after {timeout:g}s") from None
+
+    def expiries(self, symbol: str, timeout: Optional[float] = None) -> List:
+        return self._call(self.expiries_async(symbol), "expiries", timeout)
+
+    def futures_price_at(self, symbol: str, ts: pd.Timestamp, timeout: Optional[float] = None) -> float:
+        return self._call(self.futures_price_async(symbol, ts), "futures_price", timeout)
+
+    def latency_stats(self) -> pd.DataFrame:
+        return self.stats.snapshot()
+
+    def close(self) -> None:
+        self._finalizer()
@@ -0,0 +1,268 @@
+import gc, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_service import DataService, DuckDBBackend, FrameBackend
+
+
+class StubBackend:
+    def __init__(self, delay: float = 0.05, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.expiry_calls = 0
+        self.batches = []
+        self.started = threading.Event()
+        self.closed = False
+
+    def expiries(self, symbol):
+        with self.lock:
+            self.expiry_calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("boom")
+        return [symbol]
+
+    def futures_prices(self, symbol, ts_list):
+        with self.lock:
+            self.batches.append(list(ts_list))
+        self.started.set()
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("boom")
+        return [float(pd.Timestamp(t).minute) for t in ts_list]
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def make_service():
+    services = []
+
+    def _make(backend, **kw):
+        svc = DataService(backend, **kw)
+        services.append(svc)
+        return svc
+
+    yield _make
+    for svc in services:
+        svc.close()
+
+
+def _concurrently(fn, args_list):
+    with ThreadPoolExecutor(max_workers=len(args_list)) as ex:
+        return list(ex.map(lambda a: fn(*a), args_list))
+
+
+def test_identical_inflight_queries_are_coalesced(make_service):
+    backend = StubBackend()
+    svc = make_service(backend)
+    out = _concurrently(svc.expiries, [("NIFTY",)] * 50)
+    assert out == [["NIFTY"]] * 50
+    assert backend.expiry_calls == 1
+    stats = svc.latency_stats().set_index("query").loc["expiries"]
+    assert stats["calls"] == 50
+    assert stats["coalesced"] + stats["cache_hits"] == 49
+    assert stats["backend_queries"] == 1
+
+
+def test_completed_results_are_cached(make_service):
+    backend = StubBackend(delay=0.0)
+    svc = make_service(backend)
+    ts = pd.Timestamp("2020-01-01 09:20")
+    for _ in range(5):
+        assert svc.expiries("NIFTY") == ["NIFTY"]
+        assert svc.futures_price_at("NIFTY", ts) == 20.0
+    assert backend.expiry_calls == 1
+    assert len(backend.batches) == 1
+    stats = svc.latency_stats().set_index("query")
+    assert stats.loc["expiries", "cache_hits"] == 4
+    assert stats.loc["futures_price", "cache_hits"] == 4
+
+
+def test_cached_results_expire_after_ttl(make_service):
+    backend = StubBackend(delay=0.0)
+    svc = make_service(backend, cache_ttl=0.05)
+    svc.expiries("NIFTY")
+    time.sleep(0.1)
+    svc.expiries("NIFTY")
+    assert backend.expiry_calls == 2
+
+
+def _stamps(n):
+    return [pd.Timestamp("2020-01-01 09:15") + pd.Timedelta(minutes=i) for i in range(n)]
+
+
+def test_lone_point_lookup_is_not_delayed(make_service):
+    backend = StubBackend(delay=0.0)
+    svc = make_service(backend)
+    t0 = time.perf_counter()
+    for ts in _stamps(5):
+        svc.futures_price_at("NIFTY", ts)
+    assert time.perf_counter() - t0 < 0.5
+    assert [len(b) for b in backend.batches] == [1] * 5
+
+
+def test_point_lookups_queue_behind_running_scan(make_service):
+    backend = StubBackend(delay=0.3)
+    svc = make_service(backend)
+    first, *rest = _stamps(21)
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        lead = ex.submit(svc.futures_price_at, "NIFTY", first)
+        assert backend.started.wait(2)
+        out = _concurrently(svc.futures_price_at, [("NIFTY", ts) for ts in rest])
+        assert lead.result() == float(first.minute)
+    assert out == [float(ts.minute) for ts in rest]
+    assert [len(b) for b in backend.batches] == [1, 20]
+
+
+def test_point_lookups_flush_at_max_batch(make_service):
+    backend = StubBackend(delay=0.3)
+    svc = make_service(backend, max_batch=4)
+    first, *rest = _stamps(9)
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        lead = ex.submit(svc.futures_price_at, "NIFTY", first)
+        assert backend.started.wait(2)
+        out = _concurrently(svc.futures_price_at, [("NIFTY", ts) for ts in rest])
+        lead.result()
+    assert out == [float(ts.minute) for ts in rest]
+    assert [len(b) for b in backend.batches] == [1, 4, 4]
+
+
+def test_slow_backend_times_out_without_cancelling_shared_query(make_service):
+    backend = StubBackend(delay=0.5)
+    svc = make_service(backend, timeout=0.05)
+    t0 = time.perf_counter()
+    with pytest.raises(TimeoutError, match="expiries"):
+        svc.expiries("NIFTY")
+    assert time.perf_counter() - t0 < 0.4
+    time.sleep(0.6)
+    assert svc.expiries("NIFTY") == ["NIFTY"]
+    assert backend.expiry_calls == 1
+
+
+def test_nat_probe_returns_nan(make_service):
+    backend = StubBackend()
+    svc = make_service(backend)
+    assert np.isnan(svc.futures_price_at("NIFTY", pd.NaT))
+    assert backend.batches == []
+
+
+def test_backend_errors_reach_every_waiter(make_service):
+    backend = StubBackend(fail=True)
+    svc = make_service(backend)
+
+    def call(kind, ts):
+        try:
+            if kind == "expiries":
+                svc.expiries("NIFTY")
+            else:
+                svc.futures_price_at("NIFTY", ts)
+        except RuntimeError as e:
+            return str(e)
+        return None
+
+    stamps = [pd.Timestamp("2020-01-01 09:15") + pd.Timedelta(minutes=i % 5) for i in range(20)]
+    out = _concurrently(call, [("expiries", None)] * 10 + [("price", ts) for ts in stamps])
+    assert out == ["boom"] * 30
+    # Failures are not cached.
+    calls = backend.expiry_calls
+    assert call("expiries", None) == "boom"
+    assert backend.expiry_calls == calls + 1
+
+
+def test_close_runs_on_garbage_collection():
+    backend = StubBackend()
+    svc = DataService(backend)
+    thread = svc._thread
+    del svc
+    gc.collect()
+    thread.join(timeout=2)
+    assert not thread.is_alive()
+    assert backend.closed
+
+
+def _fo_frame() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    stamps = pd.date_range("2020-01-01 09:15", periods=120, freq="5min")
+    rows = []
+    for sym in ["NIFTY", "BANKNIFTY"]:
+        for ts in stamps:
+            rows.append({"SYMBOL": sym, "INSTRUMENT": "FUTIDX", "Timestamp": ts,
+                         "EXPIRY_DT": pd.Timestamp("2020-01-30"), "CLOSE": float(rng.uniform(1e4, 2e4))})
+            rows.append({"SYMBOL": sym, "INSTRUMENT": "OPTIDX", "Timestamp": ts,
+                         "EXPIRY_DT": pd.Timestamp("2020-02-27"), "CLOSE": float(rng.uniform(1, 500))})
+    return pd.DataFrame(rows)
+
+
+def _probes():
+    return [pd.Timestamp("2020-01-01 09:00"), pd.Timestamp("2020-01-01 09:15"),
+            pd.Timestamp("2020-01-01 10:07"), pd.Timestamp("2020-01-01 13:00"),
+            pd.Timestamp("2020-01-02 09:15")]
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_frame_backend_matches_boolean_filter(shuffle):
+    fo = _fo_frame()
+    if shuffle:
+        # load_fo_csv does not sort; the old filter took iloc[-1] in file order.
+        dup = fo[fo["INSTRUMENT"].eq("FUTIDX")].iloc[::7].assign(CLOSE=lambda d: d["CLOSE"] + 1)
+        fo = pd.concat([fo, dup]).sample(frac=1.0, random_state=1).reset_index(drop=True)
+    backend = FrameBackend(fo)
+    probes = _probes() + [pd.NaT]
+    got = backend.futures_prices("NIFTY", probes)
+    for ts, px in zip(probes, got):
+        r = fo[fo["SYMBOL"].eq("NIFTY") & fo["INSTRUMENT"].str.contains("FUT", na=False) & (fo["Timestamp"] <= ts)]
+        expected = float(r["CLOSE"].iloc[-1]) if len(r) else np.nan
+        np.testing.assert_equal(px, expected)
+    assert sorted(backend.expiries("NIFTY")) == [pd.Timestamp("2020-01-30").date(), pd.Timestamp("2020-02-27").date()]
+
+
+@pytest.fixture
+def parquet_dir(tmp_path):
+    pytest.importorskip("pyarrow")
+    fo = _fo_frame()
+    for sym, part in fo.groupby("SYMBOL"):
+        d = tmp_path / f"SYMBOL={sym}"
+        d.mkdir()
+        part.to_parquet(d / "part-0.parquet", index=False)
+    return tmp_path
+
+
+def test_duckdb_backend_asof_matches_point_query(parquet_dir):
+    duckdb = pytest.importorskip("duckdb")
+    backend = DuckDBBackend(parquet_dir=str(parquet_dir))
+    try:
+        got = backend.futures_prices("NIFTY", _probes())
+        con = duckdb.connect()
+        con.sql(f"CREATE VIEW fo AS SELECT * FROM read_parquet('{parquet_dir}/**/*.parquet')")
+        for ts, px in zip(_probes(), got):
+            r = con.execute("""
+                SELECT CLOSE FROM fo
+                WHERE SYMBOL = ? AND INSTRUMENT ILIKE 'FUT%' AND Timestamp <= ?
+                ORDER BY Timestamp DESC LIMIT 1
+            """, ["NIFTY", ts.to_pydatetime()]).df()
+            expected = float(r["CLOSE"].iloc[0]) if len(r) else np.nan
+            np.testing.assert_equal(px, expected)
+        assert backend.expiries("NIFTY") == [pd.Timestamp("2020-01-30").date(), pd.Timestamp("2020-02-27").date()]
+    finally:
+        backend.close()
+
+
+def test_duckdb_file_backend_does_not_hold_lock(tmp_path, parquet_dir):
+    duckdb = pytest.importorskip("duckdb")
+    db = str(tmp_path / "fo_store.duckdb")
+    con = duckdb.connect(db)
+    con.sql(f"CREATE TABLE fo AS SELECT * FROM read_parquet('{parquet_dir}/**/*.parquet')")
+    con.close()
+    backend = DuckDBBackend(duckdb_file=db)
+    assert len(backend.futures_prices("NIFTY", _probes())) == len(_probes())
+    # A writer (ingest / preprocess) must still be able to open the file.
+    writer = duckdb.connect(db)
+    writer.sql("CREATE OR REPLACE TABLE fo AS SELECT * FROM fo WHERE SYMBOL = 'NIFTY'")
+    writer.close()
+    assert backend.expiries("BANKNIFTY") == []